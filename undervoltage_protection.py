@@ -2,12 +2,46 @@
 import time
 import os
 import glob
-import statistics
 import argparse
 import logging
+from logging.handlers import MemoryHandler
 import sys
 import subprocess
 import re
+import atexit
+import fcntl
+import threading
+import signal
+import ctypes
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+try:
+    import sensors
+except (ImportError, OSError):
+    # PySensors missing, or libsensors.so itself not installed
+    sensors = None
+
+# Matches the GPU load field of a tegrastats line, e.g. "GR3D_FREQ 45%@..."
+_GR3D_RE = re.compile(rb'GR3D_FREQ\s+(\d+)%')
+# First integer of a sysfs GPU load file ("45", "45%" or "45/100")
+_LOAD_RE = re.compile(rb'(\d+)')
+
+# reboot(2) command to halt and power off (LINUX_REBOOT_CMD_POWER_OFF)
+_RB_POWER_OFF = 0x4321fedc
+
+# Formula: real[V] = raw[V] + 0.00395 * CPU + 0.01478 * GPU + 0.560
+_CPU_COEF = 0.00395
+_GPU_COEF = 0.01478
+_OFFSET = 0.560
+
+def _corrected_mean(voltages, cpu_usage, gpu_usage):
+    """Return the raw mean of the channel voltages and its load-corrected value"""
+    raw_mean = sum(voltages) / len(voltages)
+    return raw_mean, raw_mean + _CPU_COEF * cpu_usage + _GPU_COEF * gpu_usage + _OFFSET
 
 class VoltageMonitor:
     def __init__(self,
@@ -17,22 +51,142 @@ class VoltageMonitor:
                  interval=1.0,
                  log_file='/home/psd/custom_services/voltage_monitor_test_new.log',
                  undervoltage_limit=10,
+                 window=1,
                  debug=False):
         self.threshold = threshold
         self.interval = interval
         self.log_file = log_file
         self.undervoltage_limit = undervoltage_limit
         self.undervoltage_cnt = 0
+        self.window = max(1, int(window))
         self.debug = debug
 
+        # Circular buffer of the last `window` corrected readings
+        self._ring = [0.0] * self.window
+        self._ring_i = 0
+        self._ring_n = 0
+
+        # Adaptive GPU polling: back off while the GPU stays idle. A stale 0%
+        # lowers up to skip - 1 readings, which then stay in the averaging
+        # window for window - 1 more samples; capping the skip at
+        # undervoltage_limit - window + 1 keeps that run below the limit
+        self._gpu_skip = 1
+        self._gpu_skip_max = max(1, min(10, undervoltage_limit - self.window + 1))
+        self._gpu_ticks = 0
+        self._gpu_zero = 0
+        self._gpu_last = 0.0
+
+        # Latest (raw, corrected, smoothed, cpu, gpu) snapshot published by the sampler
+        self._latest = (None, None, None, 0.0, 0.0)
+        self._latest_seq = 0
+        self._cond = threading.Condition()
+        # Set by monitor() to stop the sampler before atexit teardown
+        self._stop = threading.Event()
+        self._tfd = None
+
         base = f'/sys/bus/i2c/drivers/{driver_bus}/{i2c_addr}/hwmon'
         self.hwmon_paths = glob.glob(os.path.join(base, 'hwmon*'))
         if not self.hwmon_paths:
             raise FileNotFoundError(f"No hwmon directories found under {base}")
 
+        # Prefer libsensors: chips and features are resolved once in C and
+        # read back as scaled floats
+        self._features = []
+        if sensors is not None:
+            try:
+                sensors.init()
+                atexit.register(sensors.cleanup)
+                bus, addr = i2c_addr.split('-')
+                chip_name = f'{driver_bus}-i2c-{bus}-{int(addr, 16):x}'
+                self._features = [feature
+                                  for chip in sensors.iter_detected_chips(chip_name)
+                                  for feature in chip
+                                  if feature.name.startswith('in') and 'VDD' in feature.label]
+            except Exception as e:
+                self._features = []
+                if self.debug:
+                    print(f"libsensors init failed: {e}")
+
+        # Otherwise fall back to reading the hwmon sysfs files directly
+        self._vdd_inputs = []
+        self._vdd_fds = []
+        if not self._features:
+            # Channel labels are static: find the VDD inputs once
+            for hwmon in self.hwmon_paths:
+                # look for any in*_label file
+                for lbl_path in glob.glob(os.path.join(hwmon, 'in*_label')):
+                    try:
+                        with open(lbl_path, 'r') as f:
+                            label = f.read().strip()
+                    except Exception:
+                        continue
+                    if 'VDD' not in label:
+                        continue
+                    # derive channel name, e.g. "in1" from "in1_label"
+                    channel = os.path.basename(lbl_path).split('_')[0]
+                    self._vdd_inputs.append(os.path.join(hwmon, f'{channel}_input'))
+
+            # Keep the inputs open and pread them from offset 0 each sample
+            for input_path in self._vdd_inputs:
+                try:
+                    fd = os.open(input_path, os.O_RDONLY)
+                except OSError:
+                    continue
+                self._vdd_fds.append(fd)
+                atexit.register(os.close, fd)
+
+            # Discovery runs once, so fail now and let systemd restart us
+            if not self._vdd_fds:
+                raise FileNotFoundError(f"No readable VDD channels found under {base}")
+
         # Initialize CPU usage tracking
         self._prev_idle = None
         self._prev_total = None
+        self._stat_fd = os.open('/proc/stat', os.O_RDONLY)
+        atexit.register(os.close, self._stat_fd)
+
+        # Open NVML once instead of spawning nvidia-smi every sample
+        self._nvml_handle = None
+        if pynvml is not None:
+            try:
+                pynvml.nvmlInit()
+                atexit.register(pynvml.nvmlShutdown)
+                self._nvml_handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+            except Exception as e:
+                if self.debug:
+                    print(f"NVML init failed: {e}")
+
+        # Tegra NVML can hand out a device without supporting utilization
+        # queries; probe once and let tegrastats take over in that case
+        if self._nvml_handle is not None:
+            try:
+                pynvml.nvmlDeviceGetUtilizationRates(self._nvml_handle)
+            except Exception as e:
+                if self.debug:
+                    print(f"NVML utilization unsupported: {e}")
+                self._nvml_handle = None
+                atexit.unregister(pynvml.nvmlShutdown)
+                try:
+                    pynvml.nvmlShutdown()
+                except Exception:
+                    pass
+
+        # Without usable NVML (Jetson), keep a single tegrastats process running and
+        # read its latest line each sample instead of spawning it every time
+        self._tegra = None
+        self._tegra_buf = b''
+        self._last_gpu = None
+        if self._nvml_handle is None:
+            try:
+                self._tegra = subprocess.Popen(['tegrastats', '--interval', '1000'],
+                                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                flags = fcntl.fcntl(self._tegra.stdout, fcntl.F_GETFL)
+                fcntl.fcntl(self._tegra.stdout, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+                atexit.register(self._tegra.terminate)
+            except Exception as e:
+                self._tegra = None
+                if self.debug:
+                    print(f"tegrastats start failed: {e}")
 
         if not self.debug:
             self._setup_logging()
@@ -44,16 +198,19 @@ class VoltageMonitor:
         fmt = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s',
                                 datefmt='%Y-%m-%d %H:%M:%S')
         handler.setFormatter(fmt)
-        self.logger.addHandler(handler)
+        # Buffer routine INFO lines; WARNING and above flush immediately
+        buffered = MemoryHandler(60, flushLevel=logging.WARNING, target=handler)
+        self.logger.addHandler(buffered)
 
     def get_cpu_usage(self):
         """Get current CPU usage percentage"""
         try:
-            with open('/proc/stat', 'r') as f:
-                line = f.readline()
-            cpu_times = [int(x) for x in line.split()[1:]]
-            idle_time = cpu_times[3]
-            total_time = sum(cpu_times)
+            # Only the aggregate "cpu" line is needed
+            line = os.pread(self._stat_fd, 256, 0).split(b'\n', 1)[0]
+            # cpu user nice system idle iowait irq softirq ... - stop after softirq
+            parts = line.split(None, 8)
+            idle_time = int(parts[4]) + int(parts[5])  # idle + iowait
+            total_time = sum(map(int, parts[1:8]))
             
             # Store previous values for calculation
             if self._prev_idle is None:
@@ -79,45 +236,48 @@ class VoltageMonitor:
 
     def get_gpu_usage(self):
         """Get current GPU usage percentage - improved for Jetson devices"""
-        # Method 1: Try nvidia-smi
-        try:
-            result = subprocess.run(['nvidia-smi', '--query-gpu=utilization.gpu', 
-                                   '--format=csv,noheader,nounits'], 
-                                  capture_output=True, text=True, timeout=2)
-            if result.returncode == 0 and result.stdout.strip().isdigit():
-                gpu_usage = float(result.stdout.strip())
+        # Method 1: Try NVML (persistent handle opened in __init__)
+        if self._nvml_handle is not None:
+            try:
+                gpu_usage = float(pynvml.nvmlDeviceGetUtilizationRates(self._nvml_handle).gpu)
                 if self.debug:
-                    print(f"GPU usage from nvidia-smi: {gpu_usage}%")
+                    print(f"GPU usage from NVML: {gpu_usage}%")
                 return gpu_usage
-        except Exception as e:
-            if self.debug:
-                print(f"nvidia-smi failed: {e}")
+            except Exception as e:
+                if self.debug:
+                    print(f"NVML failed: {e}")
         
-        # Method 2: Try tegrastats for Jetson devices
-        try:
-            # Run tegrastats briefly
-            proc = subprocess.Popen(['tegrastats', '--interval', '100'], 
-                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            time.sleep(0.3)  # Let it collect one sample
-            proc.terminate()
-            stdout, _ = proc.communicate(timeout=1)
-            
-            # Parse the output for GPU usage
-            lines = stdout.strip().split('\n')
-            for line in lines:
-                if 'GR3D_FREQ' in line:
-                    # Look for pattern like "GR3D_FREQ 45%@..."
-                    match = re.search(r'GR3D_FREQ\s+(\d+)%', line)
-                    if match:
-                        gpu_usage = float(match.group(1))
+        # Method 2: Drain the persistent tegrastats pipe, keep the latest value
+        if self._tegra is not None:
+            try:
+                fd = self._tegra.stdout.fileno()
+                while True:
+                    try:
+                        chunk = os.read(fd, 4096)
+                    except BlockingIOError:
+                        break
+                    if not chunk:
+                        # tegrastats exited: reap it so no zombie is left behind
+                        status = self._tegra.wait()
                         if self.debug:
-                            print(f"GPU usage from tegrastats: {gpu_usage}%")
-                        return gpu_usage
-        except Exception as e:
-            if self.debug:
-                print(f"tegrastats failed: {e}")
+                            print(f"tegrastats exited with status {status}")
+                        self._tegra = None
+                        break
+                    self._tegra_buf += chunk
+                *lines, self._tegra_buf = self._tegra_buf.split(b'\n')
+                for line in lines:
+                    match = _GR3D_RE.search(line)
+                    if match:
+                        self._last_gpu = float(match.group(1))
+                if self._last_gpu is not None:
+                    if self.debug:
+                        print(f"GPU usage from tegrastats: {self._last_gpu}%")
+                    return self._last_gpu
+            except Exception as e:
+                if self.debug:
+                    print(f"tegrastats failed: {e}")
         
-        # Method 3: Try /sys/devices/gpu.0/load (if available)
+        # Method 3: Jetson-only sysfs load (/sys/devices/gpu.0/load), the last resort
         try:
             gpu_load_paths = [
                 '/sys/devices/gpu.0/load',
@@ -126,14 +286,14 @@ class VoltageMonitor:
             ]
             for path in gpu_load_paths:
                 if os.path.exists(path):
-                    with open(path, 'r') as f:
+                    with open(path, 'rb') as f:
                         load_str = f.read().strip()
                     # Parse load (might be in format "45" or "45%" or "45/100")
-                    match = re.search(r'(\d+)', load_str)
+                    match = _LOAD_RE.search(load_str)
                     if match:
                         gpu_usage = float(match.group(1))
                         # If the value seems to be a fraction (like 45/100), adjust
-                        if '/' in load_str and gpu_usage > 100:
+                        if b'/' in load_str and gpu_usage > 100:
                             gpu_usage = gpu_usage / 100.0 * 100.0
                         if self.debug:
                             print(f"GPU usage from {path}: {gpu_usage}%")
@@ -142,103 +302,166 @@ class VoltageMonitor:
             if self.debug:
                 print(f"sysfs GPU load failed: {e}")
         
-        # Method 4: Try jetson_stats (if available)
-        try:
-            result = subprocess.run(['jtop', '--json'], capture_output=True, text=True, timeout=2)
-            if result.returncode == 0:
-                import json
-                data = json.loads(result.stdout)
-                if 'gpu' in data and 'val' in data['gpu']:
-                    gpu_usage = float(data['gpu']['val'])
-                    if self.debug:
-                        print(f"GPU usage from jtop: {gpu_usage}%")
-                    return gpu_usage
-        except Exception as e:
-            if self.debug:
-                print(f"jtop failed: {e}")
-        
         if self.debug:
             print("GPU usage: falling back to 0% (no method worked)")
         return 0.0
 
-    def correct_voltage(self, raw_voltage, cpu_usage, gpu_usage):
-        """Apply voltage correction formula based on CPU and GPU load"""
-        # Formula: real[V] = raw[V] + 0.00395 * CPU + 0.01278 * GPU + 0.560
-        corrected = raw_voltage + (0.00395 * cpu_usage) + (0.01478 * gpu_usage) + 0.560
-        return corrected
+    def _sample_gpu_usage(self):
+        """Return GPU usage, polling only every `_gpu_skip` samples while idle"""
+        if self._gpu_ticks % self._gpu_skip == 0:
+            self._gpu_last = self.get_gpu_usage()
+            if self._gpu_last == 0:
+                self._gpu_zero += 1
+                if self._gpu_zero >= 10:
+                    self._gpu_skip = min(self._gpu_skip_max, self._gpu_skip * 2)
+                    self._gpu_zero = 0
+            else:
+                self._gpu_zero = 0
+                self._gpu_skip = 1
+        self._gpu_ticks += 1
+        return self._gpu_last
+
+    def _smooth(self, value):
+        """Push a reading into the averaging window and return the window mean"""
+        self._ring[self._ring_i] = value
+        self._ring_i = (self._ring_i + 1) % self.window
+        if self._ring_n < self.window:
+            self._ring_n += 1
+        # unfilled slots are still 0.0, so the sum only covers real readings
+        return sum(self._ring) / self._ring_n
 
     def read_mean_voltage(self):
         voltages = []
-        for hwmon in self.hwmon_paths:
-            # look for any in*_label file
-            for lbl_path in glob.glob(os.path.join(hwmon, 'in*_label')):
-                try:
-                    with open(lbl_path, 'r') as f:
-                        label = f.read().strip()
-                except Exception:
-                    continue
-                if 'VDD' not in label:
-                    continue
-                # derive channel name, e.g. "in1" from "in1_label"
-                channel = os.path.basename(lbl_path).split('_')[0]
-                input_path = os.path.join(hwmon, f'{channel}_input')
-                try:
-                    with open(input_path, 'r') as f:
-                        raw = int(f.read().strip())
-                    voltages.append(raw / 1000.0)
-                except Exception:
-                    # skip channels that fail to read
-                    continue
+        # local aliases skip global/attribute lookups inside the loop
+        _int = int
+        _pread = os.pread
+        append = voltages.append
+        for feature in self._features:
+            try:
+                # libsensors already scales to volts
+                append(feature.get_value())
+            except Exception:
+                continue
+        for fd in self._vdd_fds:
+            try:
+                # int() ignores the trailing newline itself
+                append(_int(_pread(fd, 32, 0)) / 1000.0)
+            except Exception:
+                # skip channels that fail to read
+                continue
 
         if not voltages:
-            return None, None, 0.0, 0.0
-        
-        raw_mean = statistics.mean(voltages)
+            return None, None, None, 0.0, 0.0
         
         # Get CPU and GPU usage for correction
         cpu_usage = self.get_cpu_usage()
-        gpu_usage = self.get_gpu_usage()
+        gpu_usage = self._sample_gpu_usage()
         
-        # Apply voltage correction
-        corrected_mean = self.correct_voltage(raw_mean, cpu_usage, gpu_usage)
+        # Average and apply voltage correction in one step
+        raw_mean, corrected_mean = _corrected_mean(voltages, cpu_usage, gpu_usage)
+        # Window average of the corrected values, used for the threshold check
+        smoothed_mean = self._smooth(corrected_mean)
         
-        return raw_mean, corrected_mean, cpu_usage, gpu_usage
+        return raw_mean, corrected_mean, smoothed_mean, cpu_usage, gpu_usage
+
+    def _sample_loop(self):
+        """Read sensors every interval and publish the result for monitor()"""
+        # Tick on self._tfd when monitor() armed one, else on deadlines
+        next_tick = time.monotonic()
+
+        while not self._stop.is_set():
+            snapshot = self.read_mean_voltage()
+            with self._cond:
+                self._latest = snapshot
+                self._latest_seq += 1
+                self._cond.notify()
+
+            if self._tfd is not None:
+                # blocks until the next expiration; the loop test rechecks _stop
+                os.read(self._tfd, 8)
+                continue
+            next_tick += self.interval
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                # fell behind: resync instead of firing a burst of samples
+                next_tick = time.monotonic()
 
     def shutdown_system(self):
         if not self.debug:
             self.logger.warning("Undervoltage threshold exceeded. Initiating shutdown.")
-            os.system('/sbin/shutdown now')
+            # Flush filesystems and power off directly, no shell or fork/exec
+            try:
+                libc = ctypes.CDLL('libc.so.6', use_errno=True)
+                libc.sync()
+                if libc.reboot(ctypes.c_int(_RB_POWER_OFF)) != 0:
+                    err = ctypes.get_errno()
+                    raise OSError(err, os.strerror(err))
+            except OSError as e:
+                # e.g. missing CAP_SYS_BOOT: fall back to an orderly shutdown
+                self.logger.error("reboot(RB_POWER_OFF) failed: %s", e)
+                subprocess.run(['/sbin/shutdown', 'now'])
 
     def monitor(self):
         if not self.debug:
-            self.logger.info(f"Starting monitor (threshold={self.threshold}V, interval={self.interval}s)")
+            self.logger.info("Starting monitor (threshold=%sV, interval=%ss)", self.threshold, self.interval)
         
-        while True:
-            raw_v, corrected_v, cpu_usage, gpu_usage = self.read_mean_voltage()
+        # Tick on a monotonic schedule so read time does not add drift:
+        # a periodic timerfd where available (Python 3.13+), else deadlines.
+        # A zero interval would disarm the timerfd, so it uses deadlines too
+        if hasattr(os, 'timerfd_create') and self.interval > 0:
+            self._tfd = os.timerfd_create(time.CLOCK_MONOTONIC)
+            os.timerfd_settime(self._tfd, initial=self.interval, interval=self.interval)
+
+        sampler = threading.Thread(target=self._sample_loop, daemon=True)
+        sampler.start()
+        seen_seq = 0
+
+        try:
+            while True:
+                # Wait for the sampler to publish a reading we have not seen yet
+                with self._cond:
+                    self._cond.wait_for(lambda: self._latest_seq != seen_seq,
+                                        timeout=max(self.interval * 2, 1.0))
+                    if self._latest_seq == seen_seq:
+                        if not sampler.is_alive():
+                            raise RuntimeError("Sampler thread stopped")
+                        continue
+                    seen_seq = self._latest_seq
+                    raw_v, corrected_v, smoothed_v, cpu_usage, gpu_usage = self._latest
             
-            if raw_v is not None and corrected_v is not None:
-                if self.debug:
-                    # Debug mode: print raw, corrected voltage, and load info
-                    print(f"Raw: {raw_v:.3f}V, Corrected: {corrected_v:.3f}V, CPU: {cpu_usage:.1f}%, GPU: {gpu_usage:.1f}%")
-                else:
-                    # Normal mode: full logging and monitoring
-                    self.logger.info(f"Raw VDD: {raw_v:.3f}V, Corrected: {corrected_v:.3f}V, CPU: {cpu_usage:.1f}%, GPU: {gpu_usage:.1f}%")
-                    
-                    if corrected_v < self.threshold:
-                        self.undervoltage_cnt += 1
-                        self.logger.warning(f"Below threshold ({corrected_v:.3f}V). Count: {self.undervoltage_cnt}/{self.undervoltage_limit}")
-                        if self.undervoltage_cnt >= self.undervoltage_limit:
-                            self.shutdown_system()
-                            return
+                if raw_v is not None and corrected_v is not None:
+                    if self.debug:
+                        # Debug mode: print raw, corrected, smoothed voltage, and load info
+                        print(f"Raw: {raw_v:.3f}V, Corrected: {corrected_v:.3f}V, Smoothed: {smoothed_v:.3f}V, "
+                              f"CPU: {cpu_usage:.1f}%, GPU: {gpu_usage:.1f}%")
                     else:
-                        self.undervoltage_cnt = 0
-            else:
-                if self.debug:
-                    print("Error: No VDD channels found or failed to read voltages")
+                        # Normal mode: full logging and monitoring
+                        self.logger.info("Raw VDD: %.3fV, Corrected: %.3fV, Smoothed: %.3fV, CPU: %.1f%%, GPU: %.1f%%",
+                                         raw_v, corrected_v, smoothed_v, cpu_usage, gpu_usage)
+                    
+                        # count consecutive low readings; any good reading resets to 0
+                        below = smoothed_v < self.threshold
+                        self.undervoltage_cnt = (self.undervoltage_cnt + 1) * below
+                        if below:
+                            self.logger.warning("Below threshold (smoothed %.3fV). Count: %d/%d",
+                                                smoothed_v, self.undervoltage_cnt, self.undervoltage_limit)
+                            if self.undervoltage_cnt >= self.undervoltage_limit:
+                                self.shutdown_system()
+                                return
                 else:
-                    self.logger.error("No VDD channels found or failed to read any voltages")
-            
-            time.sleep(self.interval)
+                    if self.debug:
+                        print("Error: No VDD channels found or failed to read voltages")
+                    else:
+                        self.logger.error("No VDD channels found or failed to read any voltages")
+        finally:
+            # Stop sampling before atexit closes the fds, NVML and libsensors
+            self._stop.set()
+            sampler.join()
+            if self._tfd is not None:
+                os.close(self._tfd)
+                self._tfd = None
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Monitor VDD voltages from INA3221")
@@ -250,18 +473,24 @@ def parse_args():
                         help='Path to log file')
     parser.add_argument('-u', '--undervoltage_limit', type=int, default=10,
                         help='Consecutive under-threshold readings before shutdown')
+    parser.add_argument('-w', '--window', type=int, default=1,
+                        help='Number of corrected readings averaged before the threshold check')
     parser.add_argument('--debug', action='store_true',
                         help='Debug mode: only print raw and corrected voltage with load info')
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
+    # systemd stops the service with SIGTERM; exit normally so atexit
+    # handlers and logging.shutdown() still flush the buffered log lines
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
         vm = VoltageMonitor(
             threshold=args.threshold,
             interval=args.interval,
             log_file=args.log,
             undervoltage_limit=args.undervoltage_limit,
+            window=args.window,
             debug=args.debug
         )
         vm.monitor()